@@ -1,19 +1,36 @@
+import importlib.util
+import os
 import sys
 import serial
 import serial.tools.list_ports
 import numpy as np
-import time
-from collections import deque
+import struct
+from queue import SimpleQueue
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, 
                              QWidget, QPushButton, QComboBox, QLabel, QMessageBox, 
                              QGroupBox, QLineEdit, QGridLayout, QScrollArea, 
                              QPlainTextEdit, QFileDialog)
 from PyQt5.QtGui import QFont 
-from PyQt5.QtCore import QThread, pyqtSignal, QTimer, Qt
+from PyQt5.QtCore import QThread, pyqtSignal, QTimer, Qt, QMutex
 import pyqtgraph as pg
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if importlib.util.find_spec('OpenGL') is not None:
+    pg.setConfigOptions(useOpenGL=True, enableExperimental=True, antialias=False)
 
 FRAME_LEN = 40
 BAUD_RATE = 1000000
+READ_TIMEOUT = 0.1
+RX_BUF_SIZE = 65536
+RING_SIZE = 65536
+ASYNC_LOW_LATENCY = 1 << 13
+SAVE_FLUSH_SIZE = 65536
+# decode_frame costs ~1.4 us per frame, decode_frames ~21 us flat up to ~16 frames
+SCALAR_MAX_FRAMES = 16
+FRAME_STRUCT = struct.Struct('>3xBHQBHQBHIBHI')
 
 FREQ_G_MAP = {
     "2KHz": 0,
@@ -27,25 +44,88 @@ def calculate_coeffs(g):
     na = 2 ** (24 + 6 * g)
     return nf, na
 
-class SerialThread(QThread):
-    data_received_signal = pyqtSignal(list, bytes) 
+def set_low_latency(fd):
+    import array, fcntl, termios
+    serial_struct = array.array('i', [0] * 32)
+    fcntl.ioctl(fd, termios.TIOCGSERIAL, serial_struct)
+    serial_struct[4] |= ASYNC_LOW_LATENCY
+    fcntl.ioctl(fd, termios.TIOCSSERIAL, serial_struct)
+
+def decode_frame(buf, offset, inv_coeffs):
+    a1, b1, c1, a2, b2, c2, a3, b3, c3, a4, b4, c4 = FRAME_STRUCT.unpack_from(buf, offset)
+    return (
+        float((a1 << 80) | (b1 << 64) | c1) * inv_coeffs[0],
+        float((a2 << 80) | (b2 << 64) | c2) * inv_coeffs[1],
+        float((a3 << 48) | (b3 << 32) | c3) * inv_coeffs[2],
+        float((a4 << 48) | (b4 << 32) | c4) * inv_coeffs[3],
+    )
+
+def _be_uint(cols):
+    shifts = np.arange(8 * (cols.shape[1] - 1), -1, -8, dtype=np.uint64)
+    return (cols.astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64)
+
+def decode_frames(frames, inv_coeffs):
+    lo1 = np.ascontiguousarray(frames[:, 6:14]).view('>u8')[:, 0]
+    lo2 = np.ascontiguousarray(frames[:, 17:25]).view('>u8')[:, 0]
+    out = np.empty((len(frames), 4), dtype=np.float64)
+    out[:, 0] = _be_uint(frames[:, 3:6]) * 2.0 ** 64 + lo1
+    out[:, 1] = _be_uint(frames[:, 14:17]) * 2.0 ** 64 + lo2
+    out[:, 2] = _be_uint(frames[:, 25:32])
+    out[:, 3] = _be_uint(frames[:, 32:39])
+    out *= inv_coeffs
+    return out
+
+if njit is not None:
+    @njit(cache=True, boundscheck=False)
+    def _be_u64(frames, i, start, stop):
+        v = np.uint64(0)
+        for j in range(start, stop):
+            v = (v << np.uint64(8)) | np.uint64(frames[i, j])
+        return v
+
+    @njit(cache=True, boundscheck=False, fastmath=True)
+    def decode_frames_jit(frames, inv_coeffs, out):
+        for i in range(frames.shape[0]):
+            out[i, 0] = (_be_u64(frames, i, 3, 6) * 18446744073709551616.0 + _be_u64(frames, i, 6, 14)) * inv_coeffs[0]
+            out[i, 1] = (_be_u64(frames, i, 14, 17) * 18446744073709551616.0 + _be_u64(frames, i, 17, 25)) * inv_coeffs[1]
+            out[i, 2] = _be_u64(frames, i, 25, 32) * inv_coeffs[2]
+            out[i, 3] = _be_u64(frames, i, 32, 39) * inv_coeffs[3]
+
+    decode_frames_jit(np.zeros((1, FRAME_LEN), dtype=np.uint8), np.ones(4), np.zeros((1, 4)))
+else:
+    decode_frames_jit = None
 
+class SerialThread(QThread):
     def __init__(self):
         super().__init__()
         self.serial_port = serial.Serial()
         self.is_running = False
         self.port_name = ""
-        self.buffer = bytearray()
+        self.buf = bytearray(RX_BUF_SIZE)
+        self.buf_np = np.frombuffer(self.buf, dtype=np.uint8)
+        self.r = 0
+        self.w = 0
+        self.producer_ring = np.empty((RING_SIZE, 4), dtype=np.float64)
+        self.raw_ring = np.empty((RING_SIZE, FRAME_LEN), dtype=np.uint8)
+        self.write_idx = 0
+        self.mutex = QMutex()
         nf, na = calculate_coeffs(0)
-        self.current_coeffs = [nf, nf, na, na] 
+        self.inv_coeffs = np.array([1.0 / nf, 1.0 / nf, 1.0 / na, 1.0 / na], dtype=np.float64)
 
     def open_port(self, port_name):
         self.port_name = port_name
         try:
             self.serial_port.port = self.port_name
             self.serial_port.baudrate = BAUD_RATE
-            self.serial_port.timeout = 0.1
+            self.serial_port.timeout = READ_TIMEOUT
             self.serial_port.open()
+            if sys.platform.startswith('linux'):
+                try:
+                    set_low_latency(self.serial_port.fd)
+                except Exception as e:
+                    print(f"设置低延迟模式失败: {e}")
+            self.r = 0
+            self.w = 0
             self.is_running = True
             self.start()
             return True
@@ -56,6 +136,8 @@ class SerialThread(QThread):
     def close_port(self):
         self.is_running = False
         if self.serial_port.is_open:
+            self.serial_port.cancel_read()
+            self.wait()
             self.serial_port.close()
 
     def send_data(self, data_bytes):
@@ -68,60 +150,147 @@ class SerialThread(QThread):
 
     def update_frequency_gain(self, g):
         nf, na = calculate_coeffs(g)
-        self.current_coeffs = [nf, nf, na, na]
+        self.inv_coeffs = np.array([1.0 / nf, 1.0 / nf, 1.0 / na, 1.0 / na], dtype=np.float64)
         print(f"更新系数 g={g}: NF={nf:.2e}, NA={na:.2e}")
 
+    def store_rows(self, rows, frames):
+        n = len(rows)
+        start = self.write_idx % RING_SIZE
+        k = min(n, RING_SIZE - start)
+        self.mutex.lock()
+        try:
+            self.producer_ring[start:start + k] = rows[:k]
+            self.raw_ring[start:start + k] = frames[:k]
+            if n > k:
+                self.producer_ring[:n - k] = rows[k:]
+                self.raw_ring[:n - k] = frames[k:]
+            self.write_idx += n
+        finally:
+            self.mutex.unlock()
+
+    def read_rows(self, read_idx):
+        self.mutex.lock()
+        try:
+            write_idx = self.write_idx
+            dropped = max(0, write_idx - RING_SIZE - read_idx)
+            rows = self.producer_ring[np.arange(read_idx + dropped, write_idx) % RING_SIZE]
+        finally:
+            self.mutex.unlock()
+        return rows, write_idx, dropped
+
+    def read_raw(self, write_idx, count):
+        self.mutex.lock()
+        try:
+            frames = self.raw_ring[np.arange(write_idx - count, write_idx) % RING_SIZE]
+        finally:
+            self.mutex.unlock()
+        return [frame.tobytes() for frame in frames]
+
     def run(self):
         while self.is_running:
             try:
-                if self.serial_port.in_waiting:
-                    raw = self.serial_port.read(self.serial_port.in_waiting)
-                    self.buffer.extend(raw)
-                    while len(self.buffer) >= FRAME_LEN:
-                        if self.buffer[0] == 0xAA:
-                            frame = self.buffer[0:FRAME_LEN]
-                            try:
-                                val1 = int.from_bytes(frame[3:14], byteorder='big', signed=False)
-                                val2 = int.from_bytes(frame[14:25], byteorder='big', signed=False)
-                                val3 = int.from_bytes(frame[25:32], byteorder='big', signed=False)
-                                val4 = int.from_bytes(frame[32:39], byteorder='big', signed=False)
-                                processed_data = [
-                                    val1 / self.current_coeffs[0],
-                                    val2 / self.current_coeffs[1],
-                                    val3 / self.current_coeffs[2],
-                                    val4 / self.current_coeffs[3]
-                                ]
-                                self.data_received_signal.emit(processed_data, bytes(frame))
-                            except Exception as e:
-                                print(f"解析错误: {e}")
-                            del self.buffer[0:FRAME_LEN]
-                        else:
-                            del self.buffer[0]
-                else:
-                    time.sleep(0.001)
+                first = self.serial_port.read(1)
+                if first:
+                    self.buf[self.w] = first[0]
+                    self.w += 1
+                    size = min(self.serial_port.in_waiting, RX_BUF_SIZE - self.w)
+                    if size:
+                        self.w += self.serial_port.readinto(memoryview(self.buf)[self.w:self.w + size])
+                    while self.w - self.r >= FRAME_LEN:
+                        if self.buf[self.r] != 0xAA:
+                            # 0xAA inside a payload is rare; after a false start the next
+                            # header check fails and find() resyncs again.
+                            idx = self.buf.find(0xAA, self.r, self.w)
+                            if idx < 0:
+                                self.r = self.w
+                                break
+                            self.r = idx
+                            continue
+                        n = (self.w - self.r) // FRAME_LEN
+                        frames = self.buf_np[self.r:self.r + n * FRAME_LEN].reshape(n, FRAME_LEN)
+                        bad = np.flatnonzero(frames[:, 0] != 0xAA)
+                        if len(bad):
+                            n = int(bad[0])
+                            frames = frames[:n]
+                        try:
+                            if decode_frames_jit is not None:
+                                rows = np.empty((n, 4), dtype=np.float64)
+                                decode_frames_jit(frames, self.inv_coeffs, rows)
+                            elif n < SCALAR_MAX_FRAMES:
+                                rows = [decode_frame(self.buf, self.r + i * FRAME_LEN, self.inv_coeffs)
+                                        for i in range(n)]
+                            else:
+                                rows = decode_frames(frames, self.inv_coeffs)
+                            self.store_rows(rows, frames)
+                        except Exception as e:
+                            print(f"解析错误: {e}")
+                        self.r += n * FRAME_LEN
+                    if self.r > RX_BUF_SIZE // 2:
+                        self.buf[:self.w - self.r] = self.buf[self.r:self.w]
+                        self.w -= self.r
+                        self.r = 0
             except Exception as e:
                 print(f"接收线程错误: {e}")
                 self.is_running = False
 
+class SaveWorker(QThread):
+    error_signal = pyqtSignal(str)
+
+    def __init__(self, filename):
+        super().__init__()
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND | getattr(os, 'O_BINARY', 0)
+        self.fd = os.open(filename, flags)
+        self.queue = SimpleQueue()
+
+    def put(self, data):
+        self.queue.put(data)
+
+    def stop(self):
+        self.queue.put(None)
+        self.wait()
+        os.close(self.fd)
+
+    def run(self):
+        chunks = []
+        size = 0
+        while True:
+            data = self.queue.get()
+            if data is not None:
+                chunks.append(data)
+                size += len(data)
+            if data is None or size >= SAVE_FLUSH_SIZE:
+                try:
+                    view = memoryview(b"".join(chunks))
+                    while view:
+                        view = view[os.write(self.fd, view):]
+                except OSError as e:
+                    self.error_signal.emit(str(e))
+                    return
+                chunks = []
+                size = 0
+            if data is None:
+                return
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Serial_Scope_SJTU")
         self.resize(1280, 850)
         self.plot_len = 1000 
-        self.data_ch1 = deque([0]*self.plot_len, maxlen=self.plot_len)
-        self.data_ch2 = deque([0]*self.plot_len, maxlen=self.plot_len)
-        self.data_ch3 = deque([0]*self.plot_len, maxlen=self.plot_len)
-        self.data_ch4 = deque([0]*self.plot_len, maxlen=self.plot_len)
-        self.temp_buffer = [] 
-        self.save_file = None 
+        self.ring = np.zeros((4, self.plot_len), dtype=np.float64)
+        self.ridx = 0
+        self.view = np.empty_like(self.ring)
+        self._xs = np.arange(self.plot_len, dtype=np.float64)
+        self.read_idx = 0
+        self.save_worker = None 
+        self.save_binary = False
         self.is_saving = False
         self.serial_thread = SerialThread()
-        self.serial_thread.data_received_signal.connect(self.on_data_received)
         self.init_ui()
         self.timer = QTimer()
+        self.timer.setTimerType(Qt.PreciseTimer)
         self.timer.timeout.connect(self.update_plot)
-        self.timer.start(50) 
+        self.timer.start(33) 
     def init_ui(self):
         central_widget = QWidget()
         self.setCentralWidget(central_widget)
@@ -165,7 +334,6 @@ class MainWindow(QMainWindow):
             13: 0x2A, 15: 0x2B, 17: 0x2C, 19: 0x2D, 21: 0x2E
         }
         MAX_COLS = 5 
-        self.send_structure = [] 
         style_fixed = """
             QLabel {
                 background-color: #E0E0E0; 
@@ -200,12 +368,10 @@ class MainWindow(QMainWindow):
                 val = fixed_vals[i]
                 widget = QLabel(f"{val:02X}")
                 widget.setStyleSheet(style_fixed)
-                self.send_structure.append(val)
             else:
                 widget = QLineEdit("00")
                 widget.setMaxLength(2)
                 widget.setStyleSheet(style_input)
-                self.send_structure.append(widget)
                 self.user_inputs.append(widget)
             widget.setFixedSize(45, 30)
             widget.setAlignment(Qt.AlignCenter)
@@ -213,6 +379,10 @@ class MainWindow(QMainWindow):
             cell_layout.addWidget(widget)
             cell_layout.setAlignment(Qt.AlignCenter)
             grid_inputs.addLayout(cell_layout, row, col)
+        self._packet_template = bytearray(25)
+        for i, val in fixed_vals.items():
+            self._packet_template[i] = val
+        self._mut_positions = [i for i in range(25) if i not in fixed_vals]
         send_layout.addLayout(grid_inputs)
         self.btn_send = QPushButton("发送配置")
         self.btn_send.setMinimumHeight(35)
@@ -230,6 +400,7 @@ class MainWindow(QMainWindow):
         raw_layout = QVBoxLayout()
         self.txt_raw_display = QPlainTextEdit()
         self.txt_raw_display.setReadOnly(True)
+        self.txt_raw_display.setMaximumBlockCount(5)
         self.txt_raw_display.setMaximumHeight(120) 
         self.txt_raw_display.setFont(QFont("Consolas", 9)) 
         raw_layout.addWidget(self.txt_raw_display)
@@ -249,6 +420,11 @@ class MainWindow(QMainWindow):
         self.plot3 = self.graph_widget.addPlot(title="CH3"); self.curve3 = self.plot3.plot(pen='c')
         self.graph_widget.nextRow()
         self.plot4 = self.graph_widget.addPlot(title="CH4"); self.curve4 = self.plot4.plot(pen='m')
+        self.curves = (self.curve1, self.curve2, self.curve3, self.curve4)
+        for curve in self.curves:
+            curve.setClipToView(True)
+            curve.setDownsampling(auto=True, method='peak')
+            curve.curve.setSegmentedLineMode('off')
         main_layout.addWidget(scroll_area)
         main_layout.addWidget(self.graph_widget)
         self.btn_refresh.clicked.connect(self.refresh_ports)
@@ -291,73 +467,100 @@ class MainWindow(QMainWindow):
         if not self.serial_thread.is_running:
             QMessageBox.warning(self, "警告", "请先打开串口")
             return
-        packet = bytearray()
+        packet = bytearray(self._packet_template)
         try:
-            for item in self.send_structure:
-                if isinstance(item, int): packet.append(item)
-                else:
-                    text = item.text().strip()
-                    val = int(text, 16) if text else 0
-                    if not (0 <= val <= 255): raise ValueError
-                    packet.append(val)
+            for pos, widget in zip(self._mut_positions, self.user_inputs):
+                text = widget.text().strip()
+                val = int(text, 16) if text else 0
+                if not (0 <= val <= 255): raise ValueError
+                packet[pos] = val
             self.serial_thread.send_data(packet)
             self.update_coeff_only()
         except Exception as e:
             QMessageBox.critical(self, "错误", f"发送出错: {e}")
 
-    def on_data_received(self, data, raw_bytes):
-        self.temp_buffer.append((data, raw_bytes))
-
     def update_plot(self):
-        if not self.temp_buffer:
+        if self.read_idx == self.serial_thread.write_idx:
             return
-        new_processed = [x[0] for x in self.temp_buffer] 
-        new_raw = [x[1] for x in self.temp_buffer]       
-        self.temp_buffer = []
-        new_processed_np = np.array(new_processed)
-        self.data_ch1.extend(new_processed_np[:, 0])
-        self.data_ch2.extend(new_processed_np[:, 1])
-        self.data_ch3.extend(new_processed_np[:, 2])
-        self.data_ch4.extend(new_processed_np[:, 3])
-        self.curve1.setData(np.array(self.data_ch1))
-        self.curve2.setData(np.array(self.data_ch2))
-        self.curve3.setData(np.array(self.data_ch3))
-        self.curve4.setData(np.array(self.data_ch4))
-        display_chunk = new_raw[-5:] 
-        text_lines = []
-        for frame in display_chunk:
-            hex_str = " ".join([f"{b:02X}" for b in frame])
-            text_lines.append(hex_str)
-        self.txt_raw_display.setPlainText("\n".join(text_lines))
-        if self.is_saving and self.save_file:
-            try:
-                for row_data in new_processed:
-                    line = f"{row_data[0]:.8f}, {row_data[1]:.8f}, {row_data[2]:.8f}, {row_data[3]:.8f}\n"
-                    self.save_file.write(line)
-            except Exception as e:
-                print(f"写入文件失败: {e}")
+        new_processed_np, write_idx, dropped = self.serial_thread.read_rows(self.read_idx)
+        if dropped:
+            print(f"界面处理不及，丢弃 {dropped} 帧")
+            self.statusBar().showMessage(f"界面处理不及，丢弃 {dropped} 帧")
+            if self.is_saving:
                 self.stop_save()
+                self.statusBar().showMessage(f"界面处理不及，丢弃 {dropped} 帧，已停止保存")
+        for frame in self.serial_thread.read_raw(write_idx, min(5, len(new_processed_np))):
+            self.txt_raw_display.appendPlainText(frame.hex(' ').upper())
+        self.read_idx = write_idx
+        n = len(new_processed_np)
+        if n >= self.plot_len:
+            self.ring[:] = new_processed_np[-self.plot_len:].T
+            self.ridx = 0
+        else:
+            idx = (self.ridx + np.arange(n)) % self.plot_len
+            self.ring[:, idx] = new_processed_np.T
+            self.ridx = (self.ridx + n) % self.plot_len
+        k = self.plot_len - self.ridx
+        self.view[:, :k] = self.ring[:, self.ridx:]
+        self.view[:, k:] = self.ring[:, :self.ridx]
+        width = int(self.plot1.vb.width())
+        for curve, y in zip(self.curves, self.view):
+            if 0 < width * 4 < self.plot_len:
+                curve.setData(*self._m4(y, width), skipFiniteCheck=True)
+            else:
+                curve.setData(self._xs, y, skipFiniteCheck=True)
+        if self.is_saving and self.save_worker:
+            if self.save_binary:
+                self.save_worker.put(new_processed_np.astype('<f8').tobytes())
+            else:
+                self.save_worker.put(((("%.8f, %.8f, %.8f, %.8f" + os.linesep) * n) % tuple(new_processed_np.ravel())).encode())
+    def _m4(self, y, width):
+        edges = np.linspace(0, len(y), width + 1, dtype=int)
+        starts = edges[:-1]
+        ends = edges[1:] - 1
+        x = np.empty(4 * width)
+        x[0::4] = starts
+        x[1::4] = x[2::4] = (starts + ends) / 2
+        x[3::4] = ends
+        out = np.empty(4 * width)
+        out[0::4] = y[starts]
+        out[1::4] = np.minimum.reduceat(y, starts)
+        out[2::4] = np.maximum.reduceat(y, starts)
+        out[3::4] = y[ends]
+        return x, out
+
     def start_save(self):
-        filename, _ = QFileDialog.getSaveFileName(self, "保存数据", "", "Text Files (*.txt);;All Files (*)")
+        filename, _ = QFileDialog.getSaveFileName(self, "保存数据", "", "Text Files (*.txt);;Binary Files (*.bin);;All Files (*)")
         if filename:
             try:
-                self.save_file = open(filename, 'w')
+                self.save_binary = filename.lower().endswith('.bin')
+                self.save_worker = SaveWorker(filename)
+                self.save_worker.error_signal.connect(self.on_save_error)
+                if not self.save_binary:
+                    self.save_worker.put(("CH1,CH2,CH3,CH4" + os.linesep).encode())
+                self.save_worker.start()
                 self.is_saving = True
-                self.save_file.write("CH1,CH2,CH3,CH4\n")
                 self.btn_save_start.setEnabled(False)
                 self.btn_save_start.setText("保存中...")
                 self.btn_save_stop.setEnabled(True)
                 self.btn_save_stop.setStyleSheet("background-color: #ffcccc") 
             except Exception as e:
                 QMessageBox.critical(self, "错误", f"无法创建文件:\n{e}")
+    def on_save_error(self, msg):
+        if self.sender() is not self.save_worker:
+            return
+        print(f"写入文件失败: {msg}")
+        self.stop_save()
+
     def stop_save(self):
         self.is_saving = False
-        if self.save_file:
+        if self.save_worker:
+            self.save_worker.error_signal.disconnect(self.on_save_error)
             try:
-                self.save_file.close()
+                self.save_worker.stop()
             except:
                 pass
-            self.save_file = None
+            self.save_worker = None
         self.btn_save_start.setEnabled(True)
         self.btn_save_start.setText("保存")
         self.btn_save_stop.setEnabled(False)